@@ -15,8 +15,10 @@ from mathutils import Euler, Vector, Quaternion
 from math import degrees, radians
 import numpy as np
 
-from ipc import DisplayerClient
+from ipc import DisplayerClient, FrameFormat
+from metrics import format_metrics
 from profiler import Profiler
+import rawframe
 
 addon_name = __name__
 
@@ -31,23 +33,56 @@ bl_info = {
     "category": "View3D",
 }
 
+UPDATE_TICK = 0.01 # seconds between stages of the modal update operator
+
 displayer = None
 profiler  = Profiler()
 cam = None
+frame_id = 0 # ID of the most recently posed frame, written into raw frame files
+
+update_job = None # UpdateJob currently run by the modal update operator
+update_operator = None # Modal update operator instance owning update_job and its timer
+last_job   = None # Most recently finished UpdateJob; kept around for its stage timings
+displayer_metrics = None # Most recent snapshot queried from the displayer
 
 
-def render(ctx, props, filepath = None):
+def render(ctx, props, filepath = None, frame_id = 0, transport = 'PNG'):
     with profiler.segment("render"):
+        raw = transport == 'RAW'
         render = ctx.scene.render
         with TempOverride() as ovr:
             ovr.override(ctx.scene, 'camera', cam)
             ovr.override(render, 'resolution_x', props.img_width)
             ovr.override(render, 'resolution_y', props.img_height)
-            if filepath is not None: ovr.override(render, 'filepath', filepath)
-            ovr.override(render.image_settings, 'file_format', 'PNG')
+            # Blender writes the file in place, so render next to the destination and rename afterwards. Otherwise
+            # the displayer may read a half-written view of the next frame.
+            if filepath is not None: ovr.override(render, 'filepath', f'{filepath}.part')
+            ovr.override(render, 'use_file_extension', True)
+            if raw:
+                # Uncompressed TGA is the cheapest format Blender writes; it is converted to a raw frame below.
+                ovr.override(render.image_settings, 'file_format', 'TARGA_RAW')
+                ovr.override(render.image_settings, 'color_mode', 'RGBA')
+            else:
+                ovr.override(render.image_settings, 'file_format', 'PNG')
             ovr.override(ctx.scene.world.node_tree.nodes['Background'].inputs[0], 'default_value', (0, 0, 0, 1))
             
             bpy.ops.render.render(write_still=True)
+        
+        if filepath is None:
+            return
+        if raw:
+            # The frame file is renamed into place by rawframe itself.
+            with profiler.segment("convert"):
+                try:
+                    rawframe.convert(f'{filepath}.part.tga', f'{filepath}.frame', frame_id)
+                finally:
+                    # Only an intermediate, several MB per view
+                    if os.path.exists(f'{filepath}.part.tga'):
+                        os.remove(f'{filepath}.part.tga')
+        else:
+            # Renamed into place along with the frame ID, so the displayer can match up the views of a frame
+            with profiler.segment("tag png"):
+                rawframe.tag_png(f'{filepath}.part.png', f'{filepath}.png', frame_id)
 
 def acquire_camera(name):
     with profiler.segment("acquire_camera"):
@@ -128,6 +163,11 @@ def update_dimensions(props, context):
         if displayer is not None:
             displayer.setDimensions(props.width, props.height)
 
+def update_overlay(props, context):
+    with profiler.segment("update_overlay"):
+        if displayer is not None and displayer.initialized:
+            displayer.set_overlay(props.show_overlay)
+
 
 class TempOverride:
     def __init__(self):
@@ -181,6 +221,140 @@ class DreamocHD3LivePreviewProps(PropertyGroup):
         max=2160,
         update=update_dimensions,
     )
+    
+    transport : EnumProperty(
+        name="Transport",
+        description="File format the rendered views are handed to the displayer in.",
+        items=[
+            ('PNG', "PNG", "Compressed PNG images. Slow to write and to decode."),
+            ('RAW', "Raw frame", "Uncompressed frames laid out for OpenGL, memory-mapped by the displayer."),
+        ],
+        default='RAW',
+    )
+    
+    show_overlay : BoolProperty(
+        name="Show metrics overlay",
+        description="Display live performance metrics on the holographic display.",
+        default=False,
+        update=update_overlay,
+    )
+
+class UpdateJob:
+    """
+    A single preview update split into stages. The modal operator runs one stage per event loop tick so Blender's
+    UI stays responsive in between renders.
+    """
+    def __init__(self):
+        self.stages = [
+            ("pose cameras", self.pose_cameras),
+            ("render front", self.render_front),
+            ("render left",  self.render_left),
+            ("render right", self.render_right),
+            ("notify displayer", self.notify_displayer),
+        ]
+        self.current   = 0
+        self.timings   = [] # (stage name, milliseconds)
+        self.queued    = False # Another update was requested while this job was running
+        self.cancelled = False
+        
+        self.frame_id  = None
+        self.transport = None # Fixed for the whole job so all views of a frame share one format
+        self.basepos = self.basequat = self.pivot = self.offset = None
+    
+    @property
+    def done(self):
+        return self.current >= len(self.stages)
+    
+    @property
+    def stage_name(self):
+        if self.done: return "done"
+        return self.stages[self.current][0]
+    
+    def step(self, context):
+        name, stage = self.stages[self.current]
+        with profiler.segment(name) as segment:
+            stage(context)
+        self.timings.append((name, segment.diff / 10**6))
+        self.current += 1
+    
+    def pose_cameras(self, context):
+        global cam, frame_id
+        cam = acquire_camera('DreamocHD3PreviewCamera')
+        props = context.scene.dreamocpreviewprops
+        frame_id += 1
+        self.frame_id  = frame_id
+        self.transport = props.transport
+        
+        if displayer is not None and not displayer.initialized:
+            with profiler.segment("initialize displayer"):
+                displayer.initialize(display=props.display_number-1, width=props.img_width, height=props.img_height, format=FrameFormat[self.transport], overlay=props.show_overlay)
+        
+        area = _get_view3D_area(context)
+        region = _get_region3D(area)
+        ctx = {'area': area, 'region': _get_window_region(area)}
+        
+        self.pivot  = Vector(region.view_location)
+        self.offset = get_viewport_offset(region)
+        
+        # Since this is our camera we don't care about resetting it
+        cam.rotation_mode = 'QUATERNION'
+        
+        # Capture the viewport and immediately hand it back to the user so it stays untouched in between stages
+        oldcam = context.scene.camera
+        context.scene.camera = cam
+        with profiler.segment("camera to view"):
+            try: bpy.ops.view3d.camera_to_view(ctx)
+            except: pass
+        bpy.ops.view3d.view_camera(ctx)
+        context.scene.camera = oldcam
+        
+        self.basepos  = cam.location.copy()
+        self.basequat = get_object_quat(cam).copy() # Original rotation of the viewport camera
+    
+    def render_front(self, context):
+        cam.location = self.basepos
+        cam.rotation_quaternion = self.basequat
+        render(context, context.scene.dreamocpreviewprops, filepath=f'{currdir}/tmp/front', frame_id=self.frame_id, transport=self.transport)
+    
+    def render_left(self, context):
+        transform_viewport_left(cam, self.basequat, self.pivot, self.offset)
+        render(context, context.scene.dreamocpreviewprops, filepath=f'{currdir}/tmp/left', frame_id=self.frame_id, transport=self.transport)
+    
+    def render_right(self, context):
+        transform_viewport_right(cam, self.basequat, self.pivot, self.offset)
+        render(context, context.scene.dreamocpreviewprops, filepath=f'{currdir}/tmp/right', frame_id=self.frame_id, transport=self.transport)
+    
+    def notify_displayer(self, context):
+        # The displayer uploads the new renders in its own process while we may already pose the next frame.
+        if displayer is not None:
+            # The format is only switched along with the first frame rendered in it, so the displayer never looks
+            # for files of the new format before they exist.
+            format = FrameFormat[self.transport]
+            if displayer.format != format:
+                displayer.set_format(format)
+            displayer.notify()
+
+
+def _get_view3D_area(ctx):
+    for area in ctx.screen.areas:
+        if area.type == 'VIEW_3D':
+            return area
+    return None
+
+def _get_window_region(area):
+    for region in area.regions:
+        if region.type == 'WINDOW':
+            return region
+
+def _get_region3D(area):
+    assert area.type == 'VIEW_3D'
+    return area.spaces[0].region_3d
+
+def _redraw_properties(ctx):
+    for area in ctx.screen.areas:
+        if area.type == 'PROPERTIES':
+            area.tag_redraw()
+
 
 class DreamocHD3LivePreviewPanel(Panel):
     bl_idname = "OBJECT_PT_dreamoc_hd3_live_preview"
@@ -198,82 +372,160 @@ class DreamocHD3LivePreviewPanel(Panel):
         layout = self.layout
         props  = context.scene.dreamocpreviewprops
         # layout.enabled = props.enabled
+        
+        # Pressing update while an update is running queues up the next frame
         layout.operator("dreamochd3.preview_update")
+        if update_job is not None:
+            row = layout.row()
+            row.label(text=f"Updating: {update_job.stage_name} ({update_job.current}/{len(update_job.stages)})")
+            row.operator("dreamochd3.preview_cancel", text='', icon='CANCEL')
+        
         layout.prop(props, 'display_number')
         layout.prop(props, 'img_width')
         layout.prop(props, 'img_height')
+        layout.prop(props, 'transport')
+        
+        job = update_job or last_job
+        if job is not None and job.timings:
+            box = layout.box()
+            for name, ms in job.timings:
+                box.label(text=f"{name}: {ms:.1f}ms")
+            box.label(text=f"total: {sum(ms for _, ms in job.timings):.1f}ms")
+        
+        layout.prop(props, 'show_overlay')
+        layout.operator("dreamochd3.query_metrics")
+        if displayer_metrics is not None:
+            box = layout.box()
+            for line in format_metrics(displayer_metrics):
+                box.label(text=line)
 
 class DreamocHD3LivePreviewUpdateOperator(Operator):
+    """Render the three views and send them to the holographic display"""
     bl_idname = "dreamochd3.preview_update"
     bl_label  = "Update Dreamoc HD3 Preview"
     
+    _timer = None
+    
     def execute(self, context):
+        global last_job
+        # Synchronous variant, e.g. for scripting. Runs all stages at once.
+        job = UpdateJob()
         with profiler.segment("update operator"):
-            global cam
-            global dimensions_sent
-            cam = acquire_camera('DreamocHD3PreviewCamera')
-            props = context.scene.dreamocpreviewprops
-            
-            if displayer is not None and not displayer.initialized:
-                with profiler.segment("initialize displayer"):
-                    displayer.initialize(display=props.display_number-1, width=props.img_width, height=props.img_height)
-            
-            area = self._get_view3D_area(context)
-            region = self._get_region3D(area)
-            ctx = {'area': area, 'region': self._get_window_region(area)}
-            
-            oldcam = context.scene.camera
-            context.scene.camera = cam
-            
-            pivot  = Vector(region.view_location)
-            offset = get_viewport_offset(region)
-            
-            # Since this is our camera we don't care about resetting it
-            cam.rotation_mode = 'QUATERNION'
-            
-            # Front view
-            with profiler.segment("render front"):
-                with profiler.segment("camera to view"):
-                    try: bpy.ops.view3d.camera_to_view(ctx)
-                    except: pass
-                basequat = get_object_quat(cam).copy() # Original rotation of the viewport camera
-                render(context, props, filepath=f'{currdir}/tmp/front')
-            
-            # Left view
-            with profiler.segment("render left"):
-                transform_viewport_left(cam, basequat, pivot, offset)
-                render(context, props, filepath=f'{currdir}/tmp/left')
-            
-            # Right view
-            with profiler.segment("render right"):
-                transform_viewport_right(cam, basequat, pivot, offset)
-                render(context, props, filepath=f'{currdir}/tmp/right')
-            
-            # Reset viewport as if nothing ever happened
-            bpy.ops.view3d.view_camera(ctx)
-            context.scene.camera = oldcam
-            
-            # Notify displayer app
-            with profiler.segment("notify displayer"):
-                displayer.notify()
+            while not job.done:
+                job.step(context)
         
+        last_job = job
         profiler.dump().clear()
         return {'FINISHED'}
     
-    def _get_view3D_area(self, ctx):
-        for area in ctx.screen.areas:
-            if area.type == 'VIEW_3D':
-                return area
-        return None
+    def invoke(self, context, event):
+        global update_job, update_operator
+        if update_job is not None:
+            # Coalesce with the running update: at most one more frame is queued up behind it.
+            update_job.queued = True
+            return {'CANCELLED'}
+        
+        update_job = UpdateJob()
+        update_operator = self
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(UPDATE_TICK, window=context.window)
+        self._last_tick = self._timer.time_duration
+        wm.modal_handler_add(self)
+        _redraw_properties(context)
+        return {'RUNNING_MODAL'}
     
-    def _get_window_region(self, area):
-        for region in area.regions:
-            if region.type == 'WINDOW':
-                return region
+    def modal(self, context, event):
+        global update_job
+        if update_job is None or update_job.cancelled or (event.type == 'ESC' and event.value == 'PRESS'):
+            self._finish(context)
+            self.report({'INFO'}, "Dreamoc HD3 preview update cancelled")
+            return {'CANCELLED'}
+        
+        # TIMER events do not tell which timer fired. Ours has only fired if its duration advanced. Even then the
+        # event may belong to another handler's timer, so it is always passed on below.
+        if event.type != 'TIMER' or self._timer.time_duration == self._last_tick:
+            return {'PASS_THROUGH'}
+        self._last_tick = self._timer.time_duration
+        
+        try:
+            update_job.step(context)
+        except Exception as ex:
+            self._finish(context)
+            self.report({'ERROR'}, f"Dreamoc HD3 preview update failed: {ex}")
+            return {'CANCELLED', 'PASS_THROUGH'}
+        
+        _redraw_properties(context)
+        
+        if update_job.done:
+            queued = update_job.queued
+            if not queued:
+                self._finish(context)
+                return {'FINISHED', 'PASS_THROUGH'}
+            
+            # Start over on the next tick while the displayer is still busy with the frame we just sent.
+            self._retire_job()
+            update_job = UpdateJob()
+        
+        # PASS_THROUGH keeps the operator running while letting the event reach its owner
+        return {'PASS_THROUGH'}
+    
+    def cancel(self, context):
+        # Called by Blender when it aborts the modal operator itself, e.g. when loading another file.
+        self.teardown(context.window_manager)
     
-    def _get_region3D(self, area):
-        assert area.type == 'VIEW_3D'
-        return area.spaces[0].region_3d
+    def teardown(self, wm):
+        """
+        Remove the timer and drop the running job. Safe to call more than once.
+        """
+        global update_job, update_operator
+        if self._timer is not None:
+            wm.event_timer_remove(self._timer)
+            self._timer = None
+        self._retire_job()
+        update_job = None
+        if update_operator is self:
+            update_operator = None
+    
+    def _retire_job(self):
+        global last_job
+        if update_job is not None and update_job.timings:
+            last_job = update_job
+        profiler.dump().clear()
+    
+    def _finish(self, context):
+        self.teardown(context.window_manager)
+        _redraw_properties(context)
+
+class DreamocHD3LivePreviewCancelOperator(Operator):
+    """Cancel the running preview update"""
+    bl_idname = "dreamochd3.preview_cancel"
+    bl_label  = "Cancel Dreamoc HD3 Preview Update"
+    
+    @classmethod
+    def poll(cls, context):
+        return update_job is not None
+    
+    def execute(self, context):
+        update_job.cancelled = True
+        return {'FINISHED'}
+
+class DreamocHD3QueryMetricsOperator(Operator):
+    """Fetch live performance metrics from the displayer"""
+    bl_idname = "dreamochd3.query_metrics"
+    bl_label  = "Query Displayer Metrics"
+    
+    @classmethod
+    def poll(cls, context):
+        return displayer is not None and displayer.proc is not None
+    
+    def execute(self, context):
+        global displayer_metrics
+        try:
+            displayer_metrics = displayer.query_metrics()
+        except (EOFError, OSError) as ex:
+            self.report({'ERROR'}, f"Failed to query displayer metrics: {ex}")
+            return {'CANCELLED'}
+        return {'FINISHED'}
 
 
 
@@ -281,6 +533,8 @@ classes = (
     DreamocHD3LivePreviewProps,
     DreamocHD3LivePreviewPanel,
     DreamocHD3LivePreviewUpdateOperator,
+    DreamocHD3LivePreviewCancelOperator,
+    DreamocHD3QueryMetricsOperator,
 )
 
 def register():
@@ -293,6 +547,10 @@ def register():
     displayer.open()
 
 def unregister():
+    # The modal handler itself cannot be removed from here. Without job and timer it cancels on its next event.
+    if update_operator is not None:
+        update_operator.teardown(bpy.context.window_manager)
+    
     for curr in reversed(classes):
         unregister_class(curr)
     displayer.terminate()
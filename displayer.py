@@ -5,20 +5,34 @@
 
 from array import array
 from threading import Thread, Lock, Condition
-from ipc import DisplayerHost
+from ipc import DisplayerHost, FrameFormat
 from OpenGL.GL import *
 from glfw.GLFW import *
-from PIL import Image
+from PIL import Image, ImageDraw
 from profiler import Profiler
+from metrics import Metrics, format_metrics
+from rawframe import MappedFrame, GL_ORIENTATION, open_png, png_pixels
+from contextlib import ExitStack
+from time import perf_counter_ns
 import os
 import sys
+import traceback
 
 CURRDIR  = os.path.abspath(os.path.dirname(__file__))
 profiler = Profiler()
+metrics  = Metrics()
+
+OVERLAY_SIZE = (512, 160) # pixels
+OVERLAY_INTERVAL = 1 # seconds between overlay refreshes while no frames arrive
+
+
+class IncompleteFrame(Exception):
+    pass
 
 
 class Shape:
     def __init__(self, name, program, verts, uvs, image_filepath):
+        # image_filepath is without extension; it is derived from the frame format upon loading
         self.name = name
         self.program = program
         self.vao = 0
@@ -58,32 +72,45 @@ class Shape:
             glBindTexture(GL_TEXTURE_2D, self.tex)
             glDrawArrays(GL_TRIANGLES, 0, len(self.verts))
     
-    def load_texture(self):
-        with profiler.segment(f"Shape({self.name}).load_texture"):
-            with profiler.segment("Image.open"):
-                img = Image.open(self.image_filepath)
-            with profiler.segment("Image.transpose"):
-                img = img.transpose(Image.FLIP_TOP_BOTTOM).transpose(Image.FLIP_LEFT_RIGHT)
-            
+    def open_png(self):
+        """
+        Read the PNG view into memory. Returns the image and its frame ID.
+        """
+        with profiler.segment(f"Shape({self.name}).open_png"):
+            return open_png(f'{self.image_filepath}.png')
+    
+    def png_pixels(self, img):
+        with profiler.segment(f"Shape({self.name}).png_pixels"):
+            return png_pixels(img)
+    
+    def upload(self, width, height, pixels, nbytes):
+        with profiler.segment(f"Shape({self.name}).upload"):
             glBindTexture(GL_TEXTURE_2D, self.tex)
             
-            with profiler.segment("upload image"):
-                glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, img.size[0], img.size[1], 0, GL_RGBA, GL_UNSIGNED_BYTE, self._get_image_data(img).tobytes())
+            # Only time the GL call so upload_mbps does not include decoding
+            with profiler.segment("upload image") as segment:
+                glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0, GL_RGBA, GL_UNSIGNED_BYTE, pixels)
+            metrics.record_upload(nbytes, segment.diff)
+            
             with profiler.segment("generate mipmap"):
                 glGenerateMipmap(GL_TEXTURE_2D)
     
-    def _get_image_data(self, img):
-        with profiler.segment(f"Shape({self.name})._get_image_data"):
-            pixels = array('B')
-            for pixel in img.getdata():
-                pixels += array('B', pixel)
-            return pixels
+    def load_image(self, img):
+        """
+        Upload a PIL image which is not subject to the update metrics, e.g. the overlay.
+        """
+        img = img.transpose(Image.FLIP_TOP_BOTTOM).transpose(Image.FLIP_LEFT_RIGHT)
+        glBindTexture(GL_TEXTURE_2D, self.tex)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, img.size[0], img.size[1], 0, GL_RGBA, GL_UNSIGNED_BYTE, img.convert('RGBA').tobytes())
+        glGenerateMipmap(GL_TEXTURE_2D)
+    
 
 class Displayer(Thread):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.wants_terminate = False
         self.dirty = False
+        self.notified_at = None # perf_counter_ns of the first update request not yet handled
         
         self.wnd = None
         
@@ -91,9 +118,14 @@ class Displayer(Thread):
         self.wants_monitor = None
         
         self.dimensions = (1280, 720)
+        self.format = FrameFormat.PNG
+        self.show_overlay = False
+        self.overlay_lines = None # Text currently held by the overlay texture
+        self.last_frame_id = None
         
         # OpenGL resources
         self.shape_front = self.shape_left = self.shape_right = None
+        self.shape_overlay = None
         self.program = 0
         
         # Threadsafety
@@ -112,21 +144,44 @@ class Displayer(Thread):
         uvr = self._flatten_vecs( [(-0.226, 0.118), (-0.226, -0.109), (0.962, -0.109), (-0.226, 0.118), (0.962, -0.109), (0.511, 1.109), (0.511, 1.109), (0.962, -0.109), (0.962, 1.109)])
         
         # NOTE: Left view is on the right side of the holographic display and vice versa!
-        self.shape_front = Shape("front", self.program, vf, uvf, f'{CURRDIR}/tmp/front.png').initialize()
-        self.shape_left  = Shape("left",  self.program, vl, uvl, f'{CURRDIR}/tmp/right.png').initialize()
-        self.shape_right = Shape("right", self.program, vr, uvr, f'{CURRDIR}/tmp/left.png').initialize()
+        self.shape_front = Shape("front", self.program, vf, uvf, f'{CURRDIR}/tmp/front').initialize()
+        self.shape_left  = Shape("left",  self.program, vl, uvl, f'{CURRDIR}/tmp/right').initialize()
+        self.shape_right = Shape("right", self.program, vr, uvr, f'{CURRDIR}/tmp/left').initialize()
+        
+        # Metrics overlay along the bottom edge of the front view
+        vo  = self._convert_verts([(-8, -14), (8, -14), (-8, -9), (8, -14), (8, -9), (-8, -9)])
+        uvo = self._flatten_vecs( [(0, 0), (1, 0), (0, 1), (1, 0), (1, 1), (0, 1)])
+        self.shape_overlay = Shape("overlay", self.program, vo, uvo, None).initialize()
         
         glClearColor(0, 0, 0, 0)
         
         while not self.wants_terminate:
+            # Only hold the lock while consuming the requests so further updates can be queued during the upload
             with self.update_cond:
-                self.update_cond.wait_for(lambda: self.wants_terminate or self.dirty)
+                # While the overlay is shown, wake up regularly to keep its metrics live even without new frames
+                timeout = OVERLAY_INTERVAL if self.show_overlay else None
+                self.update_cond.wait_for(lambda: self.wants_terminate or self.dirty, timeout)
+                if self.wants_terminate:
+                    break
                 
-                if not self.wants_terminate:
-                    if self.wants_monitor is not None:
-                        self._change_monitor(self.wants_monitor)
-                    self.do_update()
-                    self.dirty = False
+                monitor, self.wants_monitor = self.wants_monitor, None
+                notified_at, self.notified_at = self.notified_at, None
+                self.dirty = False
+            
+            if monitor is not None:
+                self._change_monitor(monitor)
+            
+            # Built before and outside of the measured update, so the overlay does not skew the numbers it shows.
+            # It thus lags one frame behind; the next overlay refresh catches up.
+            if self.show_overlay:
+                self._refresh_overlay()
+            
+            # Only a notify from the add-on brings a new frame. Anything else merely redraws the current one.
+            if notified_at is not None:
+                metrics.record("queue", perf_counter_ns() - notified_at)
+                self.do_update()
+            else:
+                self.redraw()
         
         glfwTerminate()
     
@@ -208,7 +263,6 @@ class Displayer(Thread):
         self.monitor = self._get_monitor(monitorid)
         vidmode = glfwGetVideoMode(self.monitor)
         glfwSetWindowMonitor(self.wnd, self.monitor, 0, 0, vidmode.size.width, vidmode.size.height, vidmode.refresh_rate)
-        self.wants_monitor = None
     
     def _get_monitor(self, monitorid):
         monitors = glfwGetMonitors()
@@ -226,26 +280,138 @@ class Displayer(Thread):
         # Dimensions only take effect with the next update. They do not trigger an update themselves.
         self.dimensions = (width, height)
     
+    def set_format(self, format):
+        # Like dimensions, the format only takes effect with the next update.
+        self.format = format
+    
+    def set_overlay(self, enabled):
+        with self.update_cond:
+            self.show_overlay = enabled
+            self.dirty = True
+            self.update_cond.notify()
+    
+    def query_metrics(self):
+        return metrics.snapshot()
+    
     def update(self):
+        metrics.count("frames_received")
         with self.update_cond:
+            # If the previous request has not been picked up yet, both are served by the same update. The frame
+            # lost that way shows up as a gap in frame IDs.
+            if self.notified_at is None:
+                self.notified_at = perf_counter_ns()
             self.dirty = True
             self.update_cond.notify()
     
     def do_update(self):
-        with profiler.segment("Displayer.do_update"):
-            self.shape_front.load_texture()
-            self.shape_left.load_texture()
-            self.shape_right.load_texture()
+        with profiler.segment("Displayer.do_update") as update_segment:
+            try:
+                with profiler.segment("load textures") as segment:
+                    frame_id = self._load_textures()
+            except IncompleteFrame as ex:
+                # Expected while frames are pipelined. Not counted here either, the frame ID gap accounts for it.
+                print(ex, file=sys.stderr)
+                profiler.dump(sys.stderr).clear()
+                return
+            except Exception:
+                # Missing, stale or truncated files must not kill the render thread. Keep showing the previous
+                # textures; the next notify tries again.
+                # The frame is accounted for by the gap in frame IDs once the next frame arrives.
+                traceback.print_exc()
+                profiler.dump(sys.stderr).clear()
+                return
+            metrics.record("load", segment.diff)
+            self._count_dropped_frames(frame_id)
             
+            draw_ns, present_ns = self._draw()
+            metrics.record("draw", draw_ns)
+            metrics.record("present", present_ns)
+            metrics.present()
+        metrics.record("update", update_segment.diff)
+        
+        # stdout is reserved for IPC replies
+        profiler.dump(sys.stderr).clear()
+    
+    def redraw(self):
+        """
+        Draw the current textures again, e.g. after a monitor change or to refresh the overlay. This presents no
+        new frame, so it is left out of the metrics and the profiler dump.
+        """
+        self._draw()
+        profiler.clear()
+    
+    def _draw(self):
+        with profiler.segment("draw") as draw_segment:
             glClear(GL_COLOR_BUFFER_BIT)
             
             self.shape_front.draw()
             self.shape_left.draw()
             self.shape_right.draw()
-            
+        
+        # Not part of the frame itself
+        if self.show_overlay:
+            self.shape_overlay.draw()
+        
+        with profiler.segment("present") as present_segment:
             glfwSwapBuffers(self.wnd)
         
-        profiler.dump().clear()
+        return draw_segment.diff, present_segment.diff
+    
+    def _load_textures(self):
+        """
+        Read all three views before uploading any of them, so a broken view leaves the previous frame intact.
+        Returns the frame ID of the views.
+        """
+        shapes = (self.shape_front, self.shape_left, self.shape_right)
+        
+        if self.format != FrameFormat.RAW:
+            # Read all three files before the slow pixel conversion, which takes longer than rendering a view
+            opened = [shape.open_png() for shape in shapes]
+            self._check_frame_ids([frame_id for _, frame_id in opened])
+            
+            images = [shape.png_pixels(img) for shape, (img, _) in zip(shapes, opened)]
+            for shape, (width, height, data) in zip(shapes, images):
+                shape.upload(width, height, data, len(data))
+            return opened[0][1]
+        
+        with ExitStack() as stack:
+            frames = [stack.enter_context(MappedFrame(f'{shape.image_filepath}.frame')) for shape in shapes]
+            for frame in frames:
+                header = frame.header
+                if header.channels != 4 or header.orientation != GL_ORIENTATION:
+                    raise RuntimeError(f'Unexpected frame layout in {frame.filepath}: {header}')
+            
+            self._check_frame_ids([frame.header.frame_id for frame in frames])
+            
+            for shape, frame in zip(shapes, frames):
+                shape.upload(frame.header.width, frame.header.height, frame.pixels, frame.nbytes)
+            return frames[0].header.frame_id
+    
+    def _check_frame_ids(self, frame_ids):
+        # Views are written one after another. While the add-on is rendering the next frame, the front view may
+        # already belong to it while the sides do not. The sides of the new frame take at least another render
+        # to appear, so skip this update; the notify of the new frame triggers the next one.
+        frame_ids = set(frame_ids)
+        if len(frame_ids) > 1:
+            raise IncompleteFrame(f'Views belong to different frames: {sorted(frame_ids, key=str)}')
+    
+    def _count_dropped_frames(self, frame_id):
+        # Views carry the frame ID assigned by the add-on, so gaps are frames overwritten before we got to them.
+        if frame_id is not None and self.last_frame_id is not None and frame_id > self.last_frame_id + 1:
+            metrics.count("frames_dropped", frame_id - self.last_frame_id - 1)
+        if frame_id is not None:
+            self.last_frame_id = frame_id
+    
+    def _refresh_overlay(self):
+        lines = format_metrics(metrics.snapshot())
+        if lines == self.overlay_lines:
+            return
+        self.overlay_lines = lines
+        
+        img  = Image.new('RGBA', OVERLAY_SIZE, (0, 0, 0, 255))
+        draw = ImageDraw.Draw(img)
+        draw.multiline_text((6, 6), '\n'.join(lines), fill=(255, 255, 255, 255))
+        self.shape_overlay.load_image(img)
 
 
 def main():
@@ -2,8 +2,9 @@
 # SEE LICENSE
 
 from subprocess import Popen, PIPE, TimeoutExpired
-from sys import stdin
+from sys import stdin, stdout
 from enum import IntEnum
+import json
 import os
 
 TERMINATE_TIMEOUT = 2 # seconds
@@ -14,22 +15,33 @@ class RequestIds(IntEnum):
     USE_DISPLAY    = 2
     SET_DIMS       = 3
     RELOAD_RENDERS = 4
+    SET_FORMAT     = 5
+    QUERY_METRICS  = 6
+    SET_OVERLAY    = 7
+
+class FrameFormat(IntEnum):
+    PNG = 0
+    RAW = 1 # see rawframe.py
 
 
 class DisplayerClient:
     def __init__(self):
         self.proc = None
         self.initialized = False
+        self.format = None
     
     def open(self):
         if self.proc is None:
             currdir = os.path.abspath(os.path.dirname(__file__))
-            self.proc = Popen([f'{currdir}/venv/Scripts/python', f'{currdir}/displayer.py'], stdin=PIPE, bufsize=0)
+            self.proc = Popen([f'{currdir}/venv/Scripts/python', f'{currdir}/displayer.py'], stdin=PIPE, stdout=PIPE, bufsize=0)
             self.initialized = False
+            self.format = None
     
-    def initialize(self, display = 2, width = 1280, height = 720):
+    def initialize(self, display = 2, width = 1280, height = 720, format = FrameFormat.PNG, overlay = False):
         self.set_display(display)
         self.set_dimensions(width, height)
+        self.set_format(format)
+        self.set_overlay(overlay)
         self.initialized = True
     
     def terminate(self):
@@ -44,6 +56,19 @@ class DisplayerClient:
         buff = num.to_bytes(bytes, byteorder)
         self.proc.stdin.write(buff)
     
+    def read_int(self, bytes = 4, byteorder = 'big'):
+        return int.from_bytes(self._read(bytes), byteorder)
+    
+    def _read(self, size):
+        # stdout is unbuffered, so a single read may return fewer bytes than requested
+        buff = bytearray()
+        while len(buff) < size:
+            chunk = self.proc.stdout.read(size - len(buff))
+            if not chunk:
+                raise EOFError('Displayer closed its output')
+            buff += chunk
+        return bytes(buff)
+    
     def keepalive(self):
         self.write_int(RequestIds.KEEPALIVE)
     
@@ -58,6 +83,19 @@ class DisplayerClient:
         self.write_int(RequestIds.SET_DIMS)
         self.write_int(width)
         self.write_int(height)
+    
+    def set_format(self, format):
+        self.write_int(RequestIds.SET_FORMAT)
+        self.write_int(format)
+        self.format = format
+    
+    def set_overlay(self, enabled):
+        self.write_int(RequestIds.SET_OVERLAY)
+        self.write_int(int(enabled))
+    
+    def query_metrics(self):
+        self.write_int(RequestIds.QUERY_METRICS)
+        return json.loads(self._read(self.read_int()))
 
 
 class DisplayerHost:
@@ -77,6 +115,15 @@ class DisplayerHost:
         elif reqid == RequestIds.SET_DIMS:
             self.delegate.set_dimensions(self.read_int(), self.read_int())
         
+        elif reqid == RequestIds.SET_FORMAT:
+            self.delegate.set_format(FrameFormat(self.read_int()))
+        
+        elif reqid == RequestIds.SET_OVERLAY:
+            self.delegate.set_overlay(bool(self.read_int()))
+        
+        elif reqid == RequestIds.QUERY_METRICS:
+            self.write_message(json.dumps(self.delegate.query_metrics()).encode())
+        
         elif reqid == RequestIds.RELOAD_RENDERS:
             self.delegate.update()
         
@@ -85,3 +132,12 @@ class DisplayerHost:
     def read_int(self, bytes = 4, byteorder = 'big', signed = False):
         buff = stdin.buffer.read(bytes)
         return int.from_bytes(buff, byteorder, signed=signed)
+    
+    def write_int(self, num, bytes = 4, byteorder = 'big'):
+        stdout.buffer.write(num.to_bytes(bytes, byteorder))
+    
+    def write_message(self, buff):
+        # stdout is reserved for replies, so the displayer must not print to it.
+        self.write_int(len(buff))
+        stdout.buffer.write(buff)
+        stdout.buffer.flush()
@@ -0,0 +1,97 @@
+# Copyright (c) Skye Cobile <skye.cobile@outlook.com> 2020, Germany
+# SEE LICENSE
+# -----------
+# Live performance counters of the displayer. Unlike the Profiler, which breaks down a single update, these
+# accumulate over the whole session and can be queried at any time through the IPC protocol.
+
+from collections import deque
+from threading import Lock
+from time import perf_counter_ns
+
+WINDOW = 120 # number of most recent samples rates and percentiles are computed over
+PERCENTILES = (50, 95, 99)
+
+# Every view carries the frame ID assigned by the add-on, so a lost frame is "dropped" exactly once, found through
+# the gap in frame IDs. Whether it was coalesced with a later notify, skipped or failed to load makes no difference.
+COUNTERS = ('frames_received', 'frames_dropped', 'frames_presented')
+
+
+class Metrics:
+    def __init__(self, window = WINDOW):
+        self.lock = Lock()
+        self.window = window
+        self.counters = {name: 0 for name in COUNTERS}
+        self.latencies = {} # stage name -> deque of nanoseconds
+        self.uploads   = deque(maxlen=window) # (bytes, nanoseconds)
+        self.presents  = deque(maxlen=window) # perf_counter_ns timestamps
+    
+    def count(self, name, amount = 1):
+        with self.lock:
+            self.counters[name] += amount
+    
+    def record(self, stage, ns):
+        with self.lock:
+            if stage not in self.latencies:
+                self.latencies[stage] = deque(maxlen=self.window)
+            self.latencies[stage].append(ns)
+    
+    def record_upload(self, nbytes, ns):
+        with self.lock:
+            self.uploads.append((nbytes, ns))
+    
+    def present(self):
+        with self.lock:
+            self.counters['frames_presented'] += 1
+            self.presents.append(perf_counter_ns())
+    
+    def snapshot(self):
+        """
+        JSON serializable summary of the current state.
+        """
+        with self.lock:
+            snapshot = dict(self.counters)
+            
+            upload_ns = sum(ns for _, ns in self.uploads)
+            upload_bytes = sum(nbytes for nbytes, _ in self.uploads)
+            snapshot['upload_mbps'] = upload_bytes / 10**6 / (upload_ns / 10**9) if upload_ns else 0
+            
+            if len(self.presents) > 1:
+                snapshot['present_fps'] = (len(self.presents) - 1) / ((self.presents[-1] - self.presents[0]) / 10**9)
+            else:
+                snapshot['present_fps'] = 0
+            if self.presents:
+                snapshot['since_present_s'] = (perf_counter_ns() - self.presents[-1]) / 10**9
+            else:
+                snapshot['since_present_s'] = None
+            
+            snapshot['latency_ms'] = {
+                stage: {f'p{p}': percentile(samples, p) / 10**6 for p in PERCENTILES}
+                for stage, samples in self.latencies.items()
+            }
+            return snapshot
+
+
+def percentile(samples, p):
+    """
+    Nearest-rank percentile.
+    """
+    if not samples:
+        return 0
+    ordered = sorted(samples)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[rank - 1]
+
+def format_metrics(snapshot):
+    """
+    Human readable lines for the panel and the on-screen overlay.
+    """
+    lines = [
+        f"received {snapshot['frames_received']}, presented {snapshot['frames_presented']}",
+        f"dropped {snapshot['frames_dropped']}",
+        f"upload {snapshot['upload_mbps']:.1f} MB/s, present {snapshot['present_fps']:.2f} FPS",
+    ]
+    if snapshot['since_present_s'] is not None:
+        lines.append(f"last present {snapshot['since_present_s']:.1f}s ago")
+    for stage, latency in snapshot['latency_ms'].items():
+        lines.append(f"{stage}: " + ' / '.join(f"{ms:.1f}" for ms in latency.values()) + " ms (" + '/'.join(latency.keys()) + ")")
+    return lines
@@ -0,0 +1,275 @@
+# Copyright (c) Skye Cobile <skye.cobile@outlook.com> 2020, Germany
+# SEE LICENSE
+# -----------
+# Uncompressed frame file format used as the file transport between the Blender add-on and the displayer.
+# A frame file consists of a fixed-size header followed by the pixel rows exactly as they are uploaded to OpenGL,
+# so the displayer can simply mmap the file and hand the pixels to glTexImage2D.
+#
+# Usage as script:
+#   python rawframe.py convert <image> <frame>   Convert an image (PNG, TGA, ...) into a frame file
+#   python rawframe.py bench <image> [runs]      Compare the PNG transport against the raw frame transport
+
+from array import array
+from collections import namedtuple
+from enum import IntFlag
+from time import sleep
+import ctypes
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+MAGIC   = b'DHRF'
+VERSION = 1
+
+# magic, version, header size, width, height, channels, orientation, frame ID
+HEADER = struct.Struct('<4sHHIIBB2xQ4x')
+
+REPLACE_RETRIES = 100
+REPLACE_BACKOFF = 0.005 # seconds
+
+class Orientation(IntFlag):
+    BOTTOM_UP = 1 # First row in the file is the bottom row of the image
+    MIRRORED  = 2 # Rows are mirrored horizontally
+
+# Layout expected by the displayer: bottom-up for OpenGL and mirrored for the holographic pyramid's reflection.
+GL_ORIENTATION = Orientation.BOTTOM_UP | Orientation.MIRRORED
+
+# tEXt keyword carrying the frame ID of a PNG view, see tag_png
+PNG_FRAME_ID_KEY = 'DreamocFrameId'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+FrameHeader = namedtuple('FrameHeader', ['width', 'height', 'channels', 'orientation', 'frame_id'])
+
+
+def write_frame(filepath, pixels, frame_id, orientation = GL_ORIENTATION):
+    """
+    Write an (height, width, channels) uint8 array as frame file. The file is written next to its destination and
+    renamed in place so a reader never sees a partially written frame.
+    """
+    height, width, channels = pixels.shape
+    header = HEADER.pack(MAGIC, VERSION, HEADER.size, width, height, channels, orientation, frame_id)
+    
+    tmppath = filepath + '.tmp'
+    with open(tmppath, 'wb') as f:
+        f.write(header)
+        f.write(np.ascontiguousarray(pixels, dtype=np.uint8).data)
+    replace(tmppath, filepath)
+
+def replace(src, dst):
+    # Rename src over dst. On Windows the destination cannot be replaced while the displayer has it open or
+    # mapped. It only holds on to it while loading, so try again shortly.
+    for _ in range(REPLACE_RETRIES - 1):
+        try:
+            os.replace(src, dst)
+            return
+        except PermissionError:
+            sleep(REPLACE_BACKOFF)
+    os.replace(src, dst)
+
+def read_header(buff):
+    magic, version, header_size, width, height, channels, orientation, frame_id = HEADER.unpack_from(buff)
+    if magic != MAGIC:
+        raise ValueError('Not a frame file')
+    if version != VERSION or header_size != HEADER.size:
+        raise ValueError(f'Unsupported frame file version {version}')
+    if len(buff) < header_size + width * height * channels:
+        raise ValueError('Truncated frame file')
+    return FrameHeader(width, height, channels, Orientation(orientation), frame_id)
+
+
+class MappedFrame:
+    """
+    Read-only view onto a frame file. Use as context manager; `pixels` is only valid until the frame is closed.
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.header = None
+        self.pixels = None
+        self._file = None
+        self._mmap = None
+    
+    def __enter__(self):
+        self._file = open(self.filepath, 'rb')
+        try:
+            # Copy-on-write so ctypes can wrap the buffer. We never write to it, so no page is ever copied.
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_COPY)
+            self.header = read_header(self._mmap)
+            h = self.header
+            self.pixels = (ctypes.c_ubyte * (h.width * h.height * h.channels)).from_buffer(self._mmap, HEADER.size)
+        except:
+            self.__exit__()
+            raise
+        return self
+    
+    def __exit__(self, *args, **kwargs):
+        # The ctypes array must be released before the mapping can be closed.
+        self.pixels = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+    
+    @property
+    def nbytes(self):
+        return ctypes.sizeof(self.pixels)
+
+
+def read_tga(filepath):
+    """
+    Read an uncompressed true color TGA (as written by Blender's TARGA_RAW) into a bottom-up RGB(A) array.
+    """
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    
+    idlen, cmaptype, imgtype = data[0], data[1], data[2]
+    width, height, bpp, descriptor = struct.unpack_from('<HHBB', data, 12)
+    if cmaptype != 0 or imgtype != 2 or bpp not in (24, 32):
+        raise ValueError(f'Unsupported TGA file {filepath}: only uncompressed true color images are supported')
+    
+    channels = bpp // 8
+    offset   = 18 + idlen
+    pixels = np.frombuffer(data, np.uint8, width * height * channels, offset).reshape(height, width, channels)
+    
+    # TGA stores BGR(A)
+    pixels = pixels[:, :, [2, 1, 0, 3][:channels]]
+    if descriptor & 0x20: # top-down
+        pixels = pixels[::-1]
+    if descriptor & 0x10: # right-to-left
+        pixels = pixels[:, ::-1]
+    return pixels
+
+def read_image(filepath):
+    """
+    Read any image file into a bottom-up RGBA array.
+    """
+    if filepath.lower().endswith('.tga'):
+        pixels = read_tga(filepath)
+    else:
+        if Image is None:
+            raise RuntimeError('Pillow is required to convert image files other than TGA')
+        pixels = np.asarray(Image.open(filepath).convert('RGBA'))[::-1]
+    
+    if pixels.shape[2] == 3:
+        alpha  = np.full(pixels.shape[:2] + (1,), 255, np.uint8)
+        pixels = np.concatenate((pixels, alpha), axis=2)
+    return pixels
+
+def convert(src, dst, frame_id = 0):
+    """
+    Convert an image file into a frame file laid out for the displayer.
+    """
+    pixels = read_image(src)[:, ::-1] # mirror
+    write_frame(dst, pixels, frame_id)
+
+
+def tag_png(src, dst, frame_id):
+    """
+    Copy a PNG to dst with its frame ID in a tEXt chunk, so the displayer can tell which frame a view belongs to
+    just like with frame files. Written next to dst and renamed in place.
+    """
+    with open(src, 'rb') as f:
+        data = f.read()
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError(f'Not a PNG file: {src}')
+    
+    # Right behind IHDR, which always comes first, so PIL reads it upon opening without decoding the image
+    ihdr_end = 8 + 12 + struct.unpack_from('>I', data, 8)[0]
+    payload  = b'tEXt' + PNG_FRAME_ID_KEY.encode('latin-1') + b'\0' + str(frame_id).encode('latin-1')
+    chunk    = struct.pack('>I', len(payload) - 4) + payload + struct.pack('>I', zlib.crc32(payload))
+    
+    tmppath = dst + '.tmp'
+    with open(tmppath, 'wb') as f:
+        f.write(data[:ihdr_end])
+        f.write(chunk)
+        f.write(data[ihdr_end:])
+    replace(tmppath, dst)
+    os.remove(src)
+
+def open_png(filepath):
+    """
+    Open and read a PNG view without converting its pixels yet. Returns the image and its frame ID, if tagged.
+    PIL closes the file once the image is loaded, so the add-on can replace it right away.
+    """
+    img = Image.open(filepath)
+    img.load()
+    frame_id = img.info.get(PNG_FRAME_ID_KEY)
+    return img, int(frame_id) if frame_id is not None else None
+
+def png_pixels(img):
+    """
+    The displayer's PNG transport: lay out a decoded view for GL. Returns (width, height, pixel data).
+    """
+    img = img.transpose(Image.FLIP_TOP_BOTTOM).transpose(Image.FLIP_LEFT_RIGHT)
+    pixels = array('B')
+    for pixel in img.getdata():
+        pixels += array('B', pixel)
+    return img.size[0], img.size[1], pixels.tobytes()
+
+def decode_png(filepath):
+    return png_pixels(open_png(filepath)[0])
+
+
+def benchmark(filepath, runs = 10):
+    """
+    Compare the work each transport does outside of Blender's renderer and the GL upload: decoding the PNG in the
+    displayer against converting Blender's TGA in the add-on and mapping the frame in the displayer. Writing PNG
+    or TGA happens inside Blender and is not covered.
+    """
+    from profiler import Profiler
+    profiler = Profiler()
+    
+    base = os.path.splitext(filepath)[0]
+    pngpath, tgapath, framepath = base + '.bench.png', base + '.bench.tga', base + '.bench.frame'
+    img = Image.open(filepath).convert('RGBA')
+    img.save(pngpath)
+    img.save(tgapath, compression=None) # bottom-up and uncompressed like Blender's TARGA_RAW
+    
+    try:
+        with profiler.segment(f"PNG x{runs}"):
+            with profiler.segment("decode (displayer)"):
+                for _ in range(runs):
+                    decode_png(pngpath)
+        
+        with profiler.segment(f"frame x{runs}"):
+            with profiler.segment("convert (add-on)"):
+                for frame_id in range(runs):
+                    convert(tgapath, framepath, frame_id)
+            with profiler.segment("map (displayer)"):
+                for _ in range(runs):
+                    with MappedFrame(framepath) as frame:
+                        bytes(frame.pixels) # touch every page like glTexImage2D does
+        
+        print(f'{img.size[0]}x{img.size[1]}, PNG {os.path.getsize(pngpath)} bytes, frame {os.path.getsize(framepath)} bytes')
+        profiler.dump()
+    finally:
+        for path in (pngpath, tgapath, framepath):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def main(argv):
+    if len(argv) == 4 and argv[1] == 'convert':
+        convert(argv[2], argv[3])
+    elif len(argv) in (3, 4) and argv[1] == 'bench':
+        benchmark(argv[2], int(argv[3]) if len(argv) == 4 else 10)
+    else:
+        print(f'Usage: {argv[0]} convert <image> <frame>\n       {argv[0]} bench <image> [runs]', file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))